@@ -1,11 +1,21 @@
 from datasets import load_dataset
-import random
+import numpy as np
+import pyarrow as pa
 import json
+import sys
+from bisect import insort
 from collections import Counter, defaultdict
 import argparse
 from pathlib import Path
+from tqdm import tqdm
+
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json if orjson isn't installed
+    orjson = None
 
 SEED = 12345
+DATASET = "ncbi/MedCalc-Bench-v1.0"
 
 def _normalize(name: str) -> str:
     return name.lower().replace(" ", "").replace("_", "") if isinstance(name, str) else name
@@ -13,12 +23,15 @@ def _normalize(name: str) -> str:
 def _find_column(ds, logical_name: str, fallback_variants=None) -> str:
     """Find a column by tolerant name matching (case/space/underscore-insensitive)."""
     fallback_variants = fallback_variants or []
-    norm_map = {_normalize(n): n for n in ds.column_names}
+    names = ds.column_names
+    if names is None:  # streaming datasets may not have resolved features yet
+        names = list(next(iter(ds)).keys())
+    norm_map = {_normalize(n): n for n in names}
     targets = [_normalize(logical_name)] + [_normalize(v) for v in fallback_variants]
     for t in targets:
         if t in norm_map:
             return norm_map[t]
-    raise KeyError(f"Couldn't find a '{logical_name}' column. Available columns: {ds.column_names}")
+    raise KeyError(f"Couldn't find a '{logical_name}' column. Available columns: {names}")
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Sample MedCalc dataset with a per-question limit.")
@@ -32,42 +45,68 @@ def parse_args() -> argparse.Namespace:
 if __name__ == "__main__":
     args = parse_args()
     PER_QUESTION = args.per_question
-    ds = load_dataset("ncbi/MedCalc-Bench-v1.0", split="test")
+    # Stream just the two columns that drive grouping; no need to materialize
+    # every row (patient notes, answers, ...) into Python dicts for this pass.
+    stream = load_dataset(DATASET, split="test", streaming=True)
 
     # Locate columns (tolerant of naming)
-    QUESTION_COL = _find_column(ds, "Question", ["question"])
-    CALC_COL     = _find_column(ds, "Calculator Name",
+    QUESTION_COL = _find_column(stream, "Question", ["question"])
+    CALC_COL     = _find_column(stream, "Calculator Name",
                                 ["calculator_name", "CalculatorName", "calculatorname"])
+    stream = stream.select_columns([QUESTION_COL, CALC_COL])
 
     # Group indices by question and by (question, calculator)
     by_q = {}  # preserves insertion order (first time each question appears)
     by_q_calc = defaultdict(lambda: defaultdict(list))
+    # Inverted index: calc -> questions containing it, as an ordered "set"
+    # (dict keys) so coverage repair can stay deterministic
+    calc_to_questions = defaultdict(dict)
     all_calc_types = set()
 
-    for idx, row in enumerate(ds):
+    for idx, row in enumerate(tqdm(stream, desc="Grouping", unit=" rows")):
         qval = row.get(QUESTION_COL)
         cval = row.get(CALC_COL)
+        # Intern the dict keys: questions are multi-KB strings hashed twice
+        # per row below, and interning makes repeat lookups pointer compares
+        # on an already-cached hash
+        if isinstance(qval, str):
+            qval = sys.intern(qval)
+        if isinstance(cval, str):
+            cval = sys.intern(cval)
         if qval not in by_q:
             by_q[qval] = []
         by_q[qval].append(idx)
         by_q_calc[qval][cval].append(idx)
+        calc_to_questions[cval][qval] = None
         all_calc_types.add(cval)
 
-    # Initial deterministic sample: up to PER_QUESTION per question
-    rng = random.Random(SEED)
+    # Initial deterministic sample: up to PER_QUESTION per question.
+    # NumPy's C sampler avoids random.sample's per-call pool allocation.
+    rng = np.random.default_rng(SEED)
     selected_by_q = {}
     for qval, idxs in by_q.items():  # insertion order is deterministic from dataset order
-        k = min(PER_QUESTION, len(idxs))
-        chosen = idxs if len(idxs) <= PER_QUESTION else rng.sample(idxs, k=k)
-        selected_by_q[qval] = set(chosen)
+        if len(idxs) <= PER_QUESTION:
+            chosen = idxs
+        else:
+            chosen_pos = rng.choice(len(idxs), size=PER_QUESTION, replace=False)
+            chosen = [idxs[p] for p in chosen_pos]
+        # kept as a sorted list (<= PER_QUESTION entries) so the coverage
+        # loop below never has to re-sort per iteration
+        selected_by_q[qval] = sorted(chosen)
 
     # Build helpers for selection state
     selected_set = set()
     for s in selected_by_q.values():
         selected_set.update(s)
 
+    # Row access (and the final select) needs the full dataset from here on
+    ds = load_dataset(DATASET, split="test")
+    # Pull the calculator column once as a plain list (single columnar decode)
+    # instead of materializing a full row dict per ds[i] access below.
+    calc_col_list = ds[CALC_COL]
+
     # Coverage counts for calculator names in the current selection
-    calc_counts = Counter(ds[i][CALC_COL] for i in selected_set)
+    calc_counts = Counter(calc_col_list[i] for i in selected_set)
 
     # Determine which calculator types are missing from the selected sample
     def _sort_key(v):
@@ -77,25 +116,27 @@ if __name__ == "__main__":
     # Try to enforce coverage by swapping within question groups (keeps per-question limit)
     for m in missing:
         covered = False
-        # iterate questions in deterministic order; prefer lower row indexes when swapping
-        for qval in by_q:
-            # candidate indices of this calculator type in this question not yet selected
-            candidates = [i for i in sorted(by_q_calc[qval].get(m, [])) if i not in selected_set]
+        # iterate only questions that actually contain m (first-appearance
+        # order, so deterministic); prefer lower row indexes when swapping
+        for qval in calc_to_questions.get(m, ()):
+            # candidate indices of this calculator type in this question not yet
+            # selected; by_q_calc lists are already in ascending row order
+            candidates = [i for i in by_q_calc[qval][m] if i not in selected_set]
             if not candidates:
                 continue
 
             # can we swap one of the currently selected rows in this question?
-            current = sorted(selected_by_q[qval])  # deterministic order
+            current = selected_by_q[qval]  # sorted, so deterministic order
             # choose replacement target deterministically (lowest index candidate)
             i_new = candidates[0]
 
             # find a replaceable currently selected index that won't break other coverage
             for j_old in current:
-                old_calc = ds[j_old][CALC_COL]
+                old_calc = calc_col_list[j_old]
                 if calc_counts[old_calc] > 1:
-                    # perform swap
+                    # perform swap (keeps the per-question list sorted)
                     selected_by_q[qval].remove(j_old)
-                    selected_by_q[qval].add(i_new)
+                    insort(selected_by_q[qval], i_new)
                     selected_set.remove(j_old)
                     selected_set.add(i_new)
                     calc_counts[old_calc] -= 1
@@ -110,29 +151,40 @@ if __name__ == "__main__":
         # (This is rare; usually coverage will be achievable.)
         # You could log/print a warning here if desired.
 
-    # Finalize deterministic ordering for output
-    selected_pairs = []
+    # Finalize deterministic ordering for output: compute each question's sort
+    # key once so Timsort compares plain tuples instead of calling a key fn
+    keyed = []
     for qval in by_q:
+        sk = _sort_key(qval)
         for i in selected_by_q[qval]:
-            selected_pairs.append((qval, i))
-    selected_pairs.sort(key=lambda t: (_sort_key(t[0]), t[1]))
-    final_indices = [i for _, i in selected_pairs]
-    sampled = ds.select(final_indices)
+            keyed.append((sk, i))
+    keyed.sort()
+    final_indices = [i for _, i in keyed]
+    # Take the chosen rows straight out of the Arrow table; skips the
+    # intermediate Dataset (and extra column copy) that ds.select would build
+    sampled_tbl = ds.data.table.take(pa.array(final_indices, type=pa.int64()))
 
     # Write JSON Lines to project data directory (works from src/ or project root)
     data_dir = Path(__file__).resolve().parent.parent / "data"
     data_dir.mkdir(parents=True, exist_ok=True)
     out_path = data_dir / "medcalc_sample.jsonl"
-    with open(out_path, "w", encoding="utf-8") as f:
-        for ex in sampled:
-            json.dump(ex, f, ensure_ascii=False)
-            f.write("\n")
+    # One ready-made bytes line per example (newline included) handed to
+    # writelines on the buffered binary stream: no join copy, no per-line
+    # text encode, and syscalls amortized by the large buffer
+    if orjson is not None:
+        line = lambda ex: orjson.dumps(ex, option=orjson.OPT_APPEND_NEWLINE)
+    else:
+        line = lambda ex: (json.dumps(ex, ensure_ascii=False) + "\n").encode("utf-8")
+    CHUNK_LINES = 10_000  # rows materialized per Arrow batch
+    with open(out_path, "wb", buffering=1 << 20) as f:
+        for batch in sampled_tbl.to_batches(max_chunksize=CHUNK_LINES):
+            f.writelines(line(ex) for ex in batch.to_pylist())
 
     # Stats
-    total_count = len(sampled)
+    total_count = sampled_tbl.num_rows
     unique_questions = len(by_q)
     # unique calculator types in the selected sample
-    sample_calc_types = set(ex.get(CALC_COL) for ex in sampled)
+    sample_calc_types = {calc_col_list[i] for i in final_indices}
     num_calc_types_in_sample = len(sample_calc_types)
     num_total_calc_types = len(all_calc_types)
     coverage_ok = num_calc_types_in_sample == num_total_calc_types
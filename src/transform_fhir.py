@@ -27,12 +27,19 @@ Notes:
 from __future__ import annotations
 import argparse
 import json
+import os
 import sys
 import uuid
 import re
+from multiprocessing import Pool
 from typing import Any, Dict, List, Tuple, Set
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # fall back to stdlib json if orjson isn't installed
+    orjson = None
+
 FHIR_ID_RE = re.compile(r"^[A-Za-z0-9\-\.]{1,64}$")
 # Matches optional base (http[s]://.../fhir/), then ResourceType/id
 REF_RE = re.compile(r"^(?:https?://[^/]+/[^/]+/)?([A-Za-z][A-Za-z0-9]+)/([A-Za-z0-9\-\.]{1,64})$")
@@ -40,6 +47,9 @@ REF_RE = re.compile(r"^(?:https?://[^/]+/[^/]+/)?([A-Za-z][A-Za-z0-9]+)/([A-Za-z
 URN_SYSTEM = "urn:ietf:rfc:3986"
 URN_PREFIX = "urn:uuid:"
 
+# Sentinel distinguishing "not cached yet" from a cached None (unresolvable)
+_MISSING = object()
+
 # Resource types that PROBABLY support identifier (R4 common set). If a resource isn't listed,
 # we still add 'identifier' conservatively—most servers ignore unknown elements during non-strict
 # processing. If you want to be strict, put the allowed types here and skip others.
@@ -70,19 +80,38 @@ def gen_uuid() -> str:
     return str(uuid.uuid4())
 
 
+def gen_uuids(n: int) -> List[str]:
+    """Generate n random (version 4) UUID strings from a single os.urandom draw.
+
+    uuid.uuid4() pays a syscall plus Python-level bit twiddling per call;
+    slicing one block of randomness and setting the version/variant bits
+    directly amortizes that across the whole bundle."""
+    raw = os.urandom(16 * n)
+    out: List[str] = []
+    for i in range(0, 16 * n, 16):
+        b = bytearray(raw[i:i + 16])
+        b[6] = (b[6] & 0x0F) | 0x40  # version 4
+        b[8] = (b[8] & 0x3F) | 0x80  # RFC 4122 variant
+        out.append(str(uuid.UUID(bytes=bytes(b))))
+    return out
+
+
 def to_urn(u: str) -> str:
     return f"{URN_PREFIX}{u}"
 
 
-def add_identifier(resource: Dict[str, Any], urn_value: str) -> None:
+def add_identifier(resource: Dict[str, Any], urn_value: str, *, check_duplicate: bool = True) -> None:
     """Append an identifier with system urn:ietf:rfc:3986 and value urn:uuid:<uuid>.
-    Adds even if 'identifier' key does not previously exist."""
+    Adds even if 'identifier' key does not previously exist.
+
+    Pass check_duplicate=False to skip scanning the existing identifier list,
+    e.g. when urn_value was freshly generated and cannot already be present."""
     ident = {"system": URN_SYSTEM, "value": urn_value}
     if "identifier" in resource:
         # Ensure it's a list
         if isinstance(resource["identifier"], list):
             # Avoid duplicating exactly the same identifier
-            if not any(
+            if not check_duplicate or not any(
                 isinstance(x, dict) and x.get("system") == URN_SYSTEM and x.get("value") == urn_value
                 for x in resource["identifier"]
             ):
@@ -97,25 +126,31 @@ def add_identifier(resource: Dict[str, Any], urn_value: str) -> None:
         resource["identifier"] = [ident]
 
 
-def collect_uuid_map(bundle: Dict[str, Any]) -> Tuple[Dict[str, str], Dict[Tuple[str, str], str], Dict[str, str]]:
+def prep_entries(bundle: Dict[str, Any]) -> Tuple[
+    List[Tuple[Dict[str, Any], Dict[str, Any], str | None, str, str]],
+    Dict[str, str], Dict[Tuple[str, str], str], Dict[str, str],
+]:
     """
-    First pass: assign a new UUID per entry and collect maps for lookups.
+    First pass: assign a new UUID per entry and collect maps for lookups,
+    while also capturing everything the rewrite pass needs so entries are
+    not re-walked and fields not re-read.
 
     Returns:
+        entries_info: list of (entry, resource, resourceType, new_uuid, urn)
         by_fullurl: maps original entry.fullUrl (if present) -> urn:uuid:...
         by_type_id: maps (resourceType, old_id) -> urn:uuid:...
         by_typeid_str: maps 'ResourceType/old_id' -> urn:uuid:...
     """
+    entries_info: List[Tuple[Dict[str, Any], Dict[str, Any], str | None, str, str]] = []
     by_fullurl: Dict[str, str] = {}
     by_type_id: Dict[Tuple[str, str], str] = {}
     by_typeid_str: Dict[str, str] = {}
 
     entries = bundle.get("entry", [])
-    for e in entries:
+    for e, new_uuid in zip(entries, gen_uuids(len(entries))):
         res = e.get("resource", {})
         rtype = res.get("resourceType")
         old_id = res.get("id")
-        new_uuid = gen_uuid()
         urn = to_urn(new_uuid)
 
         # Record lookup keys for later reference rewriting
@@ -125,10 +160,9 @@ def collect_uuid_map(bundle: Dict[str, Any]) -> Tuple[Dict[str, str], Dict[Tuple
             by_type_id[(rtype, old_id)] = urn
             by_typeid_str[f"{rtype}/{old_id}"] = urn
 
-        # Stash the generated UUID directly on the entry for pass #2
-        e.setdefault("_generated_uuid", new_uuid)
+        entries_info.append((e, res, rtype, new_uuid, urn))
 
-    return by_fullurl, by_type_id, by_typeid_str
+    return entries_info, by_fullurl, by_type_id, by_typeid_str
 
 
 def sanitize_ref_string(s: str) -> str:
@@ -153,6 +187,15 @@ def map_reference(ref: str, by_fullurl: Dict[str, str], by_typeid_str: Dict[str,
       - relative 'ResourceType/id'
       - absolute 'https://host/base/ResourceType/id'
     """
+    # Fast paths on the raw string first: clean urn/contained/fullUrl/relative
+    # references dominate real bundles and need no regex normalization.
+    if ref.startswith(URN_PREFIX) or ref.startswith('#'):
+        return ref
+    if ref in by_fullurl:
+        return by_fullurl[ref]
+    if ref in by_typeid_str:
+        return by_typeid_str[ref]
+
     candidate = sanitize_ref_string(ref)
 
     # Already an urn or local contained ref
@@ -163,6 +206,13 @@ def map_reference(ref: str, by_fullurl: Dict[str, str], by_typeid_str: Dict[str,
     if candidate in by_fullurl:
         return by_fullurl[candidate]
 
+    # Relative 'ResourceType/id' (no scheme): the map keys are exactly this
+    # form, so a direct lookup replaces the regex, whose only job here was
+    # validating a shape the map already encodes.
+    if "://" not in candidate:
+        return by_typeid_str.get(candidate)
+
+    # Absolute 'https://host/base/ResourceType/id': strip the base via regex
     m = REF_RE.match(candidate)
     if m:
         key = f"{m.group(1)}/{m.group(2)}"
@@ -173,25 +223,51 @@ def map_reference(ref: str, by_fullurl: Dict[str, str], by_typeid_str: Dict[str,
     return None
 
 
-def rewrite_references(obj: Any, by_fullurl: Dict[str, str], by_typeid_str: Dict[str, str], unknown: Set[str]) -> Any:
-    """Recursively traverse the object and rewrite any 'reference' values we can map.
-    Returns the modified object (in-place for dicts/lists)."""
-    if isinstance(obj, dict):
-        for k, v in list(obj.items()):
-            if k == "reference" and isinstance(v, str):
-                mapped = map_reference(v, by_fullurl, by_typeid_str)
-                if mapped is not None:
-                    obj[k] = mapped
-                else:
-                    # Leave as-is but track
-                    if not v.startswith(URN_PREFIX) and not v.startswith('#'):
-                        unknown.add(v)
-            else:
-                rewrite_references(v, by_fullurl, by_typeid_str, unknown)
-    elif isinstance(obj, list):
-        for i in range(len(obj)):
-            rewrite_references(obj[i], by_fullurl, by_typeid_str, unknown)
-    return obj
+def rewrite_references(obj: Any, by_fullurl: Dict[str, str], by_typeid_str: Dict[str, str], unknown: Set[str],
+                       ref_cache: Dict[str, str | None] | None = None) -> int:
+    """Traverse the object with an explicit stack and rewrite any 'reference'
+    values we can map (in-place for dicts/lists). Returns the number of
+    'reference' fields visited, so callers can learn whether a subtree
+    carries references at all.
+
+    Iterative rather than recursive: deep bundles pay a Python frame per node
+    otherwise, and the work per node is only a key check. Scalars are never
+    pushed since they can't contain references.
+
+    ref_cache memoizes map_reference per raw reference string (including None
+    for unresolvable ones); shared references such as a common Patient are
+    resolved once instead of once per occurrence."""
+    if ref_cache is None:
+        ref_cache = {}
+    n_refs = 0
+    stack: List[Any] = [obj]
+    while stack:
+        node = stack.pop()
+        if type(node) is dict:
+            for k, v in node.items():
+                if k == "reference" and type(v) is str:
+                    n_refs += 1
+                    mapped = ref_cache.get(v, _MISSING)
+                    if mapped is _MISSING:
+                        mapped = map_reference(v, by_fullurl, by_typeid_str)
+                        ref_cache[v] = mapped
+                    if mapped is not None:
+                        node[k] = mapped
+                    else:
+                        # Leave as-is but track
+                        if not v.startswith(URN_PREFIX) and not v.startswith('#'):
+                            unknown.add(v)
+                elif type(v) is dict:
+                    stack.append(v)
+                elif type(v) is list:
+                    # FHIR arrays are homogeneous: a list whose first element
+                    # is a scalar (e.g. string arrays like name.given) can't
+                    # hold references, so don't bother walking it
+                    if v and type(v[0]) in (dict, list):
+                        stack.append(v)
+        elif type(node) is list:
+            stack.extend(x for x in node if type(x) is dict or type(x) is list)
+    return n_refs
 
 
 def transform_bundle(bundle: Dict[str, Any]) -> Dict[str, Any]:
@@ -211,41 +287,52 @@ def transform_bundle(bundle: Dict[str, Any]) -> Dict[str, Any]:
     else:
         bundle["identifier"] = bund_ident  # Bundle.identifier is 0..1 (object) in R4, keep as object
 
-    # 1) First pass: assign UUIDs and build lookups
-    by_fullurl, by_type_id, by_typeid_str = collect_uuid_map(bundle)
+    # 1) First pass: assign UUIDs, build lookups, and capture per-entry info
+    entries_info, by_fullurl, by_type_id, by_typeid_str = prep_entries(bundle)
 
     # 2) Rewrite each entry: set fullUrl, id, identifier; collect unknown refs while rewriting
     unknown_refs: Set[str] = set()
-    for e in bundle.get("entry", []):
-        res = e.get("resource", {})
-        rtype = res.get("resourceType")
-        new_uuid = e.get("_generated_uuid") or gen_uuid()
-        urn = to_urn(new_uuid)
-
+    ref_cache: Dict[str, str | None] = {}  # shared across entries; refs repeat a lot
+    type_has_refs: Dict[str, bool] = {}  # per-type memo: did any instance carry a reference?
+    for e, res, rtype, new_uuid, urn in entries_info:
         # fullUrl -> urn:uuid
         e["fullUrl"] = urn
 
         # resource.id -> uuid
         res["id"] = new_uuid
 
-        # resource.identifier -> include urn identifier
-        add_identifier(res, urn)
+        # resource.identifier -> include urn identifier (urn was just
+        # generated, so it cannot already be present; skip the scan)
+        add_identifier(res, urn, check_duplicate=False)
 
         # Optional: if you want to ensure identifier only for resources likely supporting it,
         # uncomment the following two lines:
         # if rtype not in LIKELY_SUPPORTS_IDENTIFIER:
         #     res.pop("identifier", None)
 
-        # Recurse through the resource to rewrite references
-        rewrite_references(res, by_fullurl, by_typeid_str, unknown_refs)
-
-        # Clean helper
-        if "_generated_uuid" in e:
-            del e["_generated_uuid"]
-
-    # 3) Rewrite any lingering references at the Bundle level (e.g., Composition.section.entry list lives in resources,
-    #     but we call again on the Bundle just in case there are other stray 'reference' fields outside entries)
-    rewrite_references(bundle, by_fullurl, by_typeid_str, unknown_refs)
+        # Walk the resource to rewrite references. Leaf types (Medication,
+        # Organization, ...) whose earlier instances carried no references get
+        # a shallow check first: if the resource is flat (no nested containers
+        # that could hide a reference) it can safely skip the walk.
+        if (
+            type_has_refs.get(rtype) is False
+            and "reference" not in res
+            and not any(type(v) is dict or type(v) is list for v in res.values())
+        ):
+            continue
+        n_refs = rewrite_references(res, by_fullurl, by_typeid_str, unknown_refs, ref_cache)
+        if rtype and not type_has_refs.get(rtype):
+            type_has_refs[rtype] = n_refs > 0
+
+    # 3) Rewrite any lingering references at the Bundle level, excluding
+    #    'entry': every entry resource was already walked above, so re-walking
+    #    the whole bundle would double the node visits. Nested containers are
+    #    shared with the shallow copy, so in-place rewrites land in the bundle;
+    #    the copy-back covers a top-level 'reference' string, if one exists.
+    bundle_shallow = {k: v for k, v in bundle.items() if k != "entry"}
+    rewrite_references(bundle_shallow, by_fullurl, by_typeid_str, unknown_refs, ref_cache)
+    for k, v in bundle_shallow.items():
+        bundle[k] = v
 
     # Warn about unresolved references
     if unknown_refs:
@@ -258,41 +345,79 @@ def transform_bundle(bundle: Dict[str, Any]) -> Dict[str, Any]:
     return bundle
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Rewrite a FHIR Bundle to use urn:uuid fullUrls and references, adding UUID ids/identifiers.")
-    parser.add_argument("-i", "--input", default="example_fhir.json", help="Path to input FHIR Bundle JSON (default: example_fhir.json)")
-    project_root = Path(__file__).resolve().parent.parent
-    default_output = str(project_root / "data" / "example_fhir_uuid.json")
-    parser.add_argument("-o", "--output", default=default_output, help="Path to write transformed JSON (default: data/example_fhir.uuid.json)")
-    parser.add_argument("--pretty", action="store_true", help="Pretty-print JSON output")
-    args = parser.parse_args()
+def transform_file(path_in: str, path_out: str, pretty: bool = False) -> int:
+    """Read a bundle from path_in, transform it, and write it to path_out.
 
+    Returns 0 on success, or a non-zero exit-style code (1: read failure,
+    2: not a Bundle, 3: write failure); errors are reported to stderr.
+    Safe to run as a multiprocessing worker — bundles are independent."""
     try:
-        with open(args.input, "r", encoding="utf-8") as f:
-            bundle = json.load(f)
+        with open(path_in, "rb") as f:
+            data = f.read()
+        bundle = orjson.loads(data) if orjson is not None else json.loads(data)
     except Exception as e:
-        print(f"Failed to read input JSON '{args.input}': {e}", file=sys.stderr)
-        sys.exit(1)
+        print(f"Failed to read input JSON '{path_in}': {e}", file=sys.stderr)
+        return 1
 
     if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
-        print("Input must be a FHIR Bundle JSON object.", file=sys.stderr)
-        sys.exit(2)
+        print(f"Input '{path_in}' must be a FHIR Bundle JSON object.", file=sys.stderr)
+        return 2
 
     transformed = transform_bundle(bundle)
 
     try:
-        out_path = Path(args.output)
+        out_path = Path(path_out)
         out_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(out_path, "w", encoding="utf-8") as f:
-            if args.pretty:
-                json.dump(transformed, f, indent=2, ensure_ascii=False)
+        with open(out_path, "wb") as f:
+            if orjson is not None:
+                f.write(orjson.dumps(transformed, option=orjson.OPT_INDENT_2 if pretty else 0))
+            elif pretty:
+                f.write(json.dumps(transformed, indent=2, ensure_ascii=False).encode("utf-8"))
             else:
-                json.dump(transformed, f, ensure_ascii=False, separators=(",", ":"))
+                f.write(json.dumps(transformed, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
     except Exception as e:
-        print(f"Failed to write output JSON '{args.output}': {e}", file=sys.stderr)
-        sys.exit(3)
+        print(f"Failed to write output JSON '{path_out}': {e}", file=sys.stderr)
+        return 3
 
     print(f"Wrote transformed bundle to {out_path}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite a FHIR Bundle to use urn:uuid fullUrls and references, adding UUID ids/identifiers.")
+    parser.add_argument("-i", "--input", default="example_fhir.json", help="Path to input FHIR Bundle JSON (default: example_fhir.json)")
+    project_root = Path(__file__).resolve().parent.parent
+    default_output = str(project_root / "data" / "example_fhir_uuid.json")
+    parser.add_argument("-o", "--output", default=default_output, help="Path to write transformed JSON (default: data/example_fhir.uuid.json)")
+    parser.add_argument("--input-dir", help="Transform every .json bundle in this directory across worker processes (requires --output-dir)")
+    parser.add_argument("--output-dir", help="Directory to write transformed bundles to, one per input file (used with --input-dir)")
+    parser.add_argument("--pretty", action="store_true", help="Pretty-print JSON output")
+    args = parser.parse_args()
+
+    if args.input_dir:
+        if not args.output_dir:
+            parser.error("--output-dir is required with --input-dir")
+        in_dir = Path(args.input_dir)
+        out_dir = Path(args.output_dir)
+        pairs = [(str(p), str(out_dir / p.name), args.pretty)
+                 for p in sorted(in_dir.glob("*.json"))]
+        if not pairs:
+            print(f"No .json files found in '{in_dir}'", file=sys.stderr)
+            sys.exit(1)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        # Bundles are independent and the work is CPU-bound (parse, UUID gen,
+        # tree walk), so processes give near-linear speedup up to core count
+        with Pool(min(os.cpu_count() or 1, len(pairs))) as pool:
+            codes = pool.starmap(transform_file, pairs)
+        n_ok = sum(1 for c in codes if c == 0)
+        print(f"Transformed {n_ok}/{len(pairs)} bundles from {in_dir} into {out_dir}")
+        if n_ok != len(pairs):
+            sys.exit(1)
+        return
+
+    code = transform_file(args.input, args.output, args.pretty)
+    if code:
+        sys.exit(code)
 
 
 if __name__ == "__main__":